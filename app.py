@@ -1,17 +1,23 @@
 from langchain_openai import AzureChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.schema import StrOutputParser
-from manimgenie.sessionpythonrepltool import SessionsPythonREPLTool,CodeBlock,extract_markdown_code_blocks
+from langchain_community.cache import SQLiteCache
+from langchain_core.outputs import Generation
+from manimgenie.sessionpythonrepltool import SessionsPythonREPLTool,CodeBlock,extract_markdown_code_blocks,extract_scene_name,extract_video_path,default_video_path,aclose_client,prewarm_access_token
+from manimgenie.videocache import video_cache_key,lookup_video,download_path,store_video
+import contextlib
+import hashlib
 import os
 import chainlit as cl
-import re
+import asyncio
+from uuid import uuid4
 
 
 apikey=os.getenv("AZUREOPENAIAPIKEY")
 azure_resource_name =os.environ.get('AZRESOURCE_NAME')
 azure_deployment_name =os.environ.get('AZDEPLOYMENT_NAME')
 BASE_URL = "https://"+azure_resource_name+".openai.azure.com"
-model = AzureChatOpenAI(streaming=False,
+model = AzureChatOpenAI(streaming=True,
                                 azure_endpoint=BASE_URL,
     openai_api_version="2024-10-01-preview",
     deployment_name=azure_deployment_name,
@@ -19,10 +25,7 @@ model = AzureChatOpenAI(streaming=False,
 
 sessionpoolurl=os.environ.get('AZSESSIONPOOLURL')
 
-@cl.on_chat_start
-async def on_chat_start():#
-
-    prompt= PromptTemplate(input_variables=["question"], 
+prompt= PromptTemplate(input_variables=["question"], 
                            template="""You're a Computer Scientist specializing in AI. You're asked to provide detailed a
                            nd eloquent answers to AI questions.\n
                            Create python code to generate a video with manim that explains the following question: \n
@@ -31,54 +34,106 @@ async def on_chat_start():#
                            Passing Mobject methods to Scene.play is no longer supported. Use Mobject.animate instead \n
                             \n\n
                             Respond only with the code """)
-    
 
-   
+# Answers whose video rendered are cached on the raw question, the key changes with the deployment and the prompt
+llm_cache = SQLiteCache(database_path=os.environ.get('LLMCACHE_PATH', '.llmcache.db'))
+ANSWER_CACHE_KEY = (
+    "manimgenie-answer:"+str(azure_deployment_name)+":"
+    +hashlib.blake2b(prompt.template.encode("utf-8"), digest_size=8).hexdigest()
+)
+
+@cl.on_app_startup
+async def on_app_startup():
+    # Fetch the session pool token in the background so the first request doesn't wait for it
+    asyncio.get_running_loop().run_in_executor(None, prewarm_access_token)
+
+@cl.on_app_shutdown
+async def on_app_shutdown():
+    await aclose_client()
+
+@cl.on_chat_start
+async def on_chat_start():#
     chain = (prompt  | model | StrOutputParser())
     cl.user_session.set("chain", chain)
+    # One tool per chat so the remote session container stays warm between messages
+    repl = SessionsPythonREPLTool(pool_management_endpoint=sessionpoolurl)
+    cl.user_session.set("repl", repl)
 
 
 @cl.on_message
 async def on_message(message: cl.Message):
     chain = cl.user_session.get("chain") 
-    res =await chain.ainvoke({"question":message.content}, config={"callbacks": [cl.LangchainCallbackHandler()]})
-   
-
-    await cl.Message(content=res).send()
+    cached = await llm_cache.alookup(message.content, ANSWER_CACHE_KEY)
+    if cached:
+        res = cached[0].text
+        await cl.Message(content=res).send()
+    else:
+        msg = cl.Message(content="")
+        res = ""
+        async for chunk in chain.astream({"question":message.content}, config={"callbacks": [cl.LangchainCallbackHandler()]}):
+            res += chunk
+            await msg.stream_token(chunk)
+        await msg.send()
     codeblock=extract_markdown_code_blocks(res)
+    if not codeblock:
+        await cl.Message("No code produced").send()
+        return
     codeblock=codeblock[0]
-    await exec_step(codeblock)
+    localvideo = await exec_step(codeblock)
+    if localvideo and not cached:
+        await llm_cache.aupdate(message.content, ANSWER_CACHE_KEY, [Generation(text=res)])
 
 @cl.step(name="Python_Execution")
 async def exec_step(codeblock:CodeBlock):
      # Utiliser une expression régulière pour extraire le nom de la scène
-    match = re.search(r'class\s+(\w+)', codeblock.code)
-    if match:
-        Scenename = match.group(1)
-    else:
-        return "No class name found in the code"
-    pool_management_endpoint=sessionpoolurl
-    repl = SessionsPythonREPLTool(pool_management_endpoint=pool_management_endpoint)
+    Scenename = extract_scene_name(codeblock.code)
+    if not Scenename:
+        await cl.Message("No class name found in the code").send()
+        return None
+    repl = cl.user_session.get("repl")
+    videokey = video_cache_key(codeblock.code)
+    localvideo = lookup_video(videokey)
+    if localvideo:
+        await send_video(repl.session_id+".mp4", localvideo)
+        return localvideo
 
-    resultmanim=await repl.ainvoke({"python_code":codeblock.code,"scene_name":Scenename})
+    # Invoked with a ToolCall so the response status comes back as the message artifact
+    toolmessage=await repl.ainvoke({
+        "args": {"python_code":codeblock.code,"scene_name":Scenename},
+        "id": str(uuid4()),
+        "name": repl.name,
+        "type": "tool_call",
+    })
+    resultmanim = str(toolmessage.content)
+    if (toolmessage.artifact or {}).get("status") != "success":
+        # Don't download, the session may still hold the video of a previous scene with the same name
+        await cl.Message("Video generation failed: "+resultmanim).send()
+        return None
+    videopath = extract_video_path(resultmanim) or default_video_path(Scenename)
+    partvideo = download_path(videokey, repl.session_id)
+    # Start the download right away and let it run while the user is notified
+    download_task = asyncio.create_task(
+        repl.adownload_file(remote_file_path=videopath, local_file_path=partvideo)
+    )
     await cl.Message("Video Generated").send()
-    promptfile="""respond only the file path when it is ready : \n
-    {manimcode} \n
-    """
-    promptfile = PromptTemplate(input_variables=["manimcode"], template=promptfile)
-    genpromptfile =await  (promptfile | model | StrOutputParser()).ainvoke({"manimcode":resultmanim})
-    await cl.Message("Downloading remote path "+genpromptfile).send()
-    vid=repl.download_file(remote_file_path=genpromptfile)
-    with open(repl.session_id+".mp4", "wb") as f:
-             f.write(vid.getvalue())
+    await cl.Message("Downloading remote path "+videopath).send()
+    try:
+        await download_task
+    except Exception:
+        # Don't leave a partial download in the cache directory
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partvideo)
+        raise
+    # Only reached once the render succeeded and this video was downloaded
+    localvideo = await asyncio.to_thread(store_video, videokey, partvideo)
+    await send_video(repl.session_id+".mp4", localvideo)
+    return localvideo
+
+async def send_video(name:str, path:str):
     elements = [
-            cl.Video(name=repl.session_id+".mp4", path="./"+repl.session_id+".mp4", display="inline"),
+            cl.Video(name=name, path=path, display="inline"),
         ]
     await cl.Message(
         content="Video is finished, here is the result:",
         elements=elements,
     ).send()
-    return repl.session_id+".mp4"
-
-
-
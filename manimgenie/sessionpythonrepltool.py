@@ -4,18 +4,35 @@ This module provides the SessionsPythonREPLTool class for
 managing dynamic sessions in Azure.
 """
 
+import asyncio
+import os
 import re
+import threading
 import urllib
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from io import BytesIO
-from typing import Any, BinaryIO, Callable, List, Literal, Optional, Tuple
+from typing import Any, Callable, List, Literal, Optional, Tuple
 from uuid import uuid4
 
+import httpx
 import requests
-from azure.core.credentials import AccessToken
-from azure.identity import DefaultAzureCredential
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from azure.core.credentials import AccessToken, TokenCredential
+from azure.identity import (
+    ChainedTokenCredential,
+    DefaultAzureCredential,
+    EnvironmentCredential,
+    ManagedIdentityCredential,
+)
 from langchain_core.tools import BaseTool
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from pydantic import Field, PrivateAttr, model_validator
 
 
 
@@ -26,39 +43,163 @@ class CodeBlock:
     code: str
     language: str
 
+_CODE_BLOCK_RE = re.compile(r"```(?:\s*([\w\+\-]+))?\n([\s\S]*?)```")
+_CLASS_NAME_RE = re.compile(r"class\s+(\w+)")
+_VIDEO_PATH_RE = re.compile(r"/mnt/data/\S+\.mp4")
+
 def extract_markdown_code_blocks(markdown_text: str) -> List[CodeBlock]:
-    pattern = re.compile(r"```(?:\s*([\w\+\-]+))?\n([\s\S]*?)```")
-    matches = pattern.findall(markdown_text)
-    code_blocks: List[CodeBlock] = []
-    for match in matches:
-        language = match[0].strip() if match[0] else ""
-        code_content = match[1]
-        code_blocks.append(CodeBlock(code=code_content, language=language))
-    return code_blocks
+    return [
+        CodeBlock(code=code, language=language.strip() if language else "")
+        for language, code in _CODE_BLOCK_RE.findall(markdown_text)
+    ]
+
+def extract_scene_name(python_code: str) -> Optional[str]:
+    """Return the name of the first class defined in the code, if any."""
+    match = _CLASS_NAME_RE.search(python_code)
+    return match.group(1) if match else None
+
+def extract_video_path(output: str) -> Optional[str]:
+    """Return the path of the rendered mp4 under `/mnt/data` found in the manim output, if any.
+
+    manim logs the partial movie file of every animation before the final video
+    (`File ready at ...`), so the last path outside `partial_movie_files` is used.
+    """
+    paths = [
+        path for path in _VIDEO_PATH_RE.findall(output)
+        if "/partial_movie_files/" not in path
+    ]
+    return paths[-1] if paths else None
+
+def default_video_path(scene_name: str) -> str:
+    """Return the path manim writes the video to for `manim -qh <scene>.py <scene> -o <scene>.mp4`."""
+    return f"/mnt/data/media/videos/{scene_name}/1080p60/{scene_name}.mp4"
 
 
 
 USER_AGENT = f"langchain-azure-dynamic-manim/custom (Language=Python)"
 
+_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(600.0, connect=10.0),
+    limits=httpx.Limits(max_keepalive_connections=32),
+)
+"""Shared async HTTP client, so connections to the session pool are reused."""
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+"""Status codes of session pool responses that are retried with backoff."""
+
+def _retrying_session(status_forcelist: frozenset) -> requests.Session:
+    """Create a pooled session retrying the given status codes with backoff."""
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_maxsize=16,
+            # Only status codes are retried, a read error may mean the render already ran
+            max_retries=Retry(
+                total=3,
+                read=0,
+                other=0,
+                backoff_factor=0.2,
+                status_forcelist=status_forcelist,
+                allowed_methods=None,
+                raise_on_status=False,
+            ),
+        ),
+    )
+    return session
+
+
+_session = _retrying_session(RETRYABLE_STATUS_CODES)
+"""Shared sync HTTP session, used by the sync methods of the tool."""
+
+# The video may not be written yet when the download starts, so 404 is retried too
+_download_session = _retrying_session(RETRYABLE_STATUS_CODES | {404})
+"""Shared sync HTTP session, used by `download_file`."""
+
+_create_and_generate_supported = True
+"""Whether the session pool has the combined create and generate route, learned once per process."""
+
+
+async def aclose_client() -> None:
+    """Close the shared HTTP clients."""
+    await _client.aclose()
+    _session.close()
+    _download_session.close()
+
+
+_credential: Optional[TokenCredential] = None
+_cached_token: Optional[AccessToken] = None
+_token_lock = threading.Lock()
 
-def _access_token_provider_factory() -> Callable[[], Optional[str]]:
-    """Factory function for creating an access token provider function.
+
+def _create_credential() -> TokenCredential:
+    """Create the credential used to access the session pool.
+
+    Only the environment (service principal) and managed identity credentials are
+    tried, the user-assigned identity is selected with `AZURE_CLIENT_ID`. Set
+    `AZURE_USE_DEFAULT_CREDENTIAL` to fall back to the full `DefaultAzureCredential` chain.
 
     Returns:
-        Callable[[], Optional[str]]: The access token provider function
+        TokenCredential: The credential
     """
-    access_token: Optional[AccessToken] = None
+    if os.getenv("AZURE_USE_DEFAULT_CREDENTIAL", "").lower() in ("1", "true", "yes"):
+        return DefaultAzureCredential()
+    return ChainedTokenCredential(
+        EnvironmentCredential(),
+        ManagedIdentityCredential(client_id=os.getenv("AZURE_CLIENT_ID")),
+    )
+
 
-    def access_token_provider() -> Optional[str]:
-        nonlocal access_token
-        if access_token is None or datetime.fromtimestamp(
-            access_token.expires_on, timezone.utc
+def _access_token_provider() -> Optional[str]:
+    """Return a session pool access token, shared by every tool instance.
+
+    The credential and the token are cached at module level and the token is
+    refreshed when it expires in less than 5 minutes.
+
+    Returns:
+        Optional[str]: The access token
+    """
+    global _credential, _cached_token
+    with _token_lock:
+        if _cached_token is None or datetime.fromtimestamp(
+            _cached_token.expires_on, timezone.utc
         ) < datetime.now(timezone.utc) + timedelta(minutes=5):
-            credential = DefaultAzureCredential()
-            access_token = credential.get_token("https://dynamicsessions.io/.default")
-        return access_token.token
+            if _credential is None:
+                _credential = _create_credential()
+            _cached_token = _credential.get_token("https://dynamicsessions.io/.default")
+        return _cached_token.token
+
+
+def prewarm_access_token() -> None:
+    """Fetch the access token ahead of the first request.
+
+    Failures are only printed, the token is fetched again on first use.
+    """
+    try:
+        _access_token_provider()
+    except Exception as e:
+        print(f"Access token prewarm failed: {e}")
+
+
+def _manim_command(scene_name: str) -> str:
+    """Return the command rendering the scene from `<scene_name>.py` to `<scene_name>.mp4`."""
+    return "manim -qh "+scene_name+".py "+scene_name +" -o "+scene_name+".mp4"
 
-    return access_token_provider
+
+_SANITIZE_LEADING_RE = re.compile(r"[\s`]*(?i:python)?\s*")
+_SANITIZE_TRAILING_RE = re.compile(r"[\s`]+$")
+
+
+def _to_content_and_artifact(response: dict) -> Tuple[str, dict]:
+    """Return the tool content, the output or the error message, and the raw response."""
+    if response.get("status") == "success":
+        result = response.get("output")
+    else:
+        result = response.get("message")
+    return result,response
 
 
 def _sanitize_input(query: str) -> str:
@@ -73,10 +214,9 @@ def _sanitize_input(query: str) -> str:
         str: The sanitized query
     """
     # Removes `, whitespace & python from start
-    query = re.sub(r"^(\s|`)*(?i:python)?\s*", "", query)
+    query = query[_SANITIZE_LEADING_RE.match(query).end():]
     # Removes whitespace & ` from end
-    query = re.sub(r"(\s|`)*$", "", query)
-    return query
+    return _SANITIZE_TRAILING_RE.sub("", query, count=1)
 
 
 @dataclass
@@ -164,27 +304,79 @@ class SessionsPythonREPLTool(BaseTool):
     pool_management_endpoint: str
     """The management endpoint of the session pool. Should end with a '/'."""
 
-    access_token_provider: Callable[[], Optional[str]] = (
-        _access_token_provider_factory()
-    )
+    access_token_provider: Callable[[], Optional[str]] = _access_token_provider
     """A function that returns the access token to use for the session pool."""
 
-    session_id: str = str(uuid4())
+    session_id: str = Field(default_factory=lambda: str(uuid4()))
     """The session ID to use for the code interpreter. Defaults to a random UUID."""
 
     response_format: Literal["content_and_artifact"] = "content_and_artifact"
 
-    def _build_url(self, path: str) -> str:
+    _url_prefix: str = PrivateAttr(default="")
+    _url_query: str = PrivateAttr(default="")
+
+    @model_validator(mode="after")
+    def validate_endpoint(self) -> "SessionsPythonREPLTool":
+        """Precompute the parts of the session pool urls that don't depend on the path."""
         pool_management_endpoint = self.pool_management_endpoint
         if not pool_management_endpoint:
             raise ValueError("pool_management_endpoint is not set")
         if not pool_management_endpoint.endswith("/"):
             pool_management_endpoint += "/"
+        self._url_prefix = pool_management_endpoint
         encoded_session_id = urllib.parse.quote(self.session_id)
-        query = f"identifier={encoded_session_id}"#&api-version=2024-02-02-preview"
         query_separator = "&" if "?" in pool_management_endpoint else "?"
-        full_url = pool_management_endpoint + path + query_separator + query
-        return full_url
+        self._url_query = query_separator + f"identifier={encoded_session_id}"#&api-version=2024-02-02-preview"
+        return self
+
+    def _build_url(self, path: str) -> str:
+        return f"{self._url_prefix}{path}{self._url_query}"
+
+    async def _post_with_retry(
+        self,
+        url: str,
+        *,
+        stream: bool = False,
+        retry_status_codes: frozenset = RETRYABLE_STATUS_CODES,
+        expected_status_codes: frozenset = frozenset(),
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """POST to the session pool, retrying transient errors with exponential backoff.
+
+        Args:
+            url: The url to post to.
+            stream: Whether to return the response before reading its body.
+                The caller must close a streamed response.
+            retry_status_codes: The status codes to retry, other errors are raised at once.
+            expected_status_codes: Error status codes the caller handles, their body isn't printed.
+            **kwargs: Passed to `httpx.AsyncClient.build_request`.
+
+        Returns:
+            httpx.Response: The successful response.
+        """
+
+        def is_retryable(e: BaseException) -> bool:
+            return (
+                isinstance(e, httpx.HTTPStatusError)
+                and e.response.status_code in retry_status_codes
+            )
+
+        async for attempt in AsyncRetrying(
+            wait=wait_exponential_jitter(initial=0.5, max=10),
+            stop=stop_after_attempt(4),
+            retry=retry_if_exception(is_retryable),
+            reraise=True,
+        ):
+            with attempt:
+                request = _client.build_request("POST", url, **kwargs)
+                response = await _client.send(request, stream=stream)
+                if response.is_error:
+                    await response.aread()
+                    if response.status_code not in expected_status_codes:
+                        print(response.text)
+                    await response.aclose()
+                response.raise_for_status()
+                return response
 
     def createfile(self,pythoncode:str,scene_name:str):
         """Create a python code file in the session."""
@@ -195,10 +387,9 @@ class SessionsPythonREPLTool(BaseTool):
             "Content-Type": "application/json",
             "User-Agent": USER_AGENT,
         }
-        pyfile=scene_name+".py"
-        datatosend = BytesIO((pyfile + "\n" + pythoncode).encode('utf-8'))
-        
-        response = requests.post(api_url, headers=headers, data=datatosend)
+        datatosend = f"{scene_name}.py\n{pythoncode}".encode('utf-8')
+
+        response = _session.post(api_url, headers=headers, data=datatosend)
         try:
             response.raise_for_status()
         except Exception as e:
@@ -219,53 +410,129 @@ class SessionsPythonREPLTool(BaseTool):
         }
         
         body = { 
-            "command": "manim -qh "+scene_name+".py "+scene_name +" -o "+scene_name+".mp4"  
-        }  
+            "command": _manim_command(scene_name)
+        }
 
-        response = requests.post(api_url, headers=headers, json=body)
+        response = _session.post(api_url, headers=headers, json=body)
         try:
             response.raise_for_status()
         except Exception as e:
             print(response.text)
-            if response.status_code == 500:
-                response = requests.post(api_url, headers=headers, json=body)
-                response.raise_for_status()
-            else:
-                raise e
+            raise e
         response_json = response.json()
         return response_json
 
-    def _run(self, python_code: str, **kwargs: Any) -> Tuple[str, dict]:
-        match = re.search(r'class\s+(\w+)', python_code)
-        if match:
-            scene_name = match.group(1)
-        else:
-            return "No class name found in the code"
+    def _run(
+        self, python_code: str, scene_name: Optional[str] = None, **kwargs: Any
+    ) -> Tuple[str, dict]:
+        # Sync callers use the shared requests.Session rather than asyncio.run over
+        # _arun, the shared httpx.AsyncClient is bound to the app's event loop.
+        scene_name = scene_name or extract_scene_name(python_code)
+        if not scene_name:
+            return "No class name found in the code",{}
         if(self.createfile(python_code,scene_name)):
             response = self.execute(scene_name)
         else:
             return "Error creating file",{}
-        if response.get("status") == "success":
-            result = response.get("output")
-        else:
-            result = response.get("message")
-        return result,response
+        return _to_content_and_artifact(response)
+
+    async def acreatefile(self,pythoncode:str,scene_name:str):
+        """Create a python code file in the session asynchronously."""
+        access_token = await asyncio.to_thread(self.access_token_provider)
+        api_url = self._build_url("manim/create")
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "User-Agent": USER_AGENT,
+        }
+        datatosend = f"{scene_name}.py\n{pythoncode}".encode('utf-8')
+
+        response = await self._post_with_retry(api_url, headers=headers, content=datatosend)
+        if response.status_code == 200:
+            return True
+
+    async def aexecute(self,scene_name:str) -> Any:
+        """Execute Python code in the session asynchronously."""
+
+        access_token = await asyncio.to_thread(self.access_token_provider)
+        api_url = self._build_url("manim/generate")
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "User-Agent": USER_AGENT,
+        }
+
+        body = {
+            "command": _manim_command(scene_name)
+        }
+
+        response = await self._post_with_retry(api_url, headers=headers, json=body)
+        response_json = response.json()
+        return response_json
+
+    async def acreate_and_execute(self,scene_name:str,pythoncode:str) -> Optional[Any]:
+        """Create the code file and execute it in the session with a single request.
+
+        Returns:
+            Optional[Any]: The execution result, or None if the session pool has no
+                combined endpoint and the file must be created then executed separately.
+        """
+        global _create_and_generate_supported
+        if not _create_and_generate_supported:
+            return None
+        access_token = await asyncio.to_thread(self.access_token_provider)
+        api_url = self._build_url("manim/create_and_generate")
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "User-Agent": USER_AGENT,
+        }
+        body = {
+            "filename": f"{scene_name}.py",
+            "code": pythoncode,
+            "command": _manim_command(scene_name),
+        }
+        try:
+            response = await self._post_with_retry(
+                api_url, headers=headers, json=body, expected_status_codes=frozenset({404})
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                _create_and_generate_supported = False
+                return None
+            raise e
+        return response.json()
+
+    async def _arun(
+        self, python_code: str, scene_name: Optional[str] = None, **kwargs: Any
+    ) -> Tuple[str, dict]:
+        scene_name = scene_name or extract_scene_name(python_code)
+        if not scene_name:
+            return "No class name found in the code",{}
+        response = await self.acreate_and_execute(scene_name,python_code)
+        if response is None:
+            if(await self.acreatefile(python_code,scene_name)):
+                response = await self.aexecute(scene_name)
+            else:
+                return "Error creating file",{}
+        return _to_content_and_artifact(response)
 
 
 
     def download_file(
-        self, *, remote_file_path: str, local_file_path: Optional[str] = None
-    ) -> BinaryIO:
+        self, *, remote_file_path: str, local_file_path: str
+    ) -> str:
         """Download a file from the session.
 
+        The response is streamed to disk in chunks, the file is never held in memory.
+
         Args:
             remote_file_path: The path to download the file from,
                 relative to `/mnt/data`.
             local_file_path: The path to save the downloaded file to.
-                If not provided, the file is returned as a BufferedReader.
 
         Returns:
-            BinaryIO: The data of the downloaded file.
+            str: The path of the downloaded file.
         """
         access_token = self.access_token_provider()
         api_url = self._build_url(f"manim/get_video")
@@ -276,18 +543,55 @@ class SessionsPythonREPLTool(BaseTool):
         body= {
                 "videofile": remote_file_path.replace("'","")
             }
-        response = requests.post(api_url, headers=headers, json=body)
+        response = _download_session.post(api_url, headers=headers, json=body, stream=True)
         try:
             response.raise_for_status()
         except Exception as e:
             print(response.text)
-            if response.status_code == 404:
-                response = requests.post(api_url, headers=headers, json=body)
-                response.raise_for_status()
             raise e
 
-        if local_file_path:
-            with open(local_file_path, "wb") as f:
-                f.write(response.content)
+        with response, open(local_file_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+        return local_file_path
+
+    async def adownload_file(
+        self, *, remote_file_path: str, local_file_path: str
+    ) -> str:
+        """Download a file from the session asynchronously.
+
+        The response is streamed to disk in chunks, the file is never held in memory.
+
+        Args:
+            remote_file_path: The path to download the file from,
+                relative to `/mnt/data`.
+            local_file_path: The path to save the downloaded file to.
 
-        return BytesIO(response.content)
+        Returns:
+            str: The path of the downloaded file.
+        """
+        access_token = await asyncio.to_thread(self.access_token_provider)
+        api_url = self._build_url(f"manim/get_video")
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "User-Agent": USER_AGENT,
+        }
+        body= {
+                "videofile": remote_file_path.replace("'","")
+            }
+        # The video may not be written yet when the download starts, so 404 is retried too
+        response = await self._post_with_retry(
+            api_url,
+            headers=headers,
+            json=body,
+            stream=True,
+            retry_status_codes=RETRYABLE_STATUS_CODES | {404},
+        )
+        try:
+            with open(local_file_path, "wb") as f:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        finally:
+            await response.aclose()
+        return local_file_path
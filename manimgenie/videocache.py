@@ -0,0 +1,93 @@
+"""On-disk cache of rendered videos.
+
+Videos are stored as `<key>.mp4` in the cache directory, where the key is a
+hash of the manim code that produced them. The least recently used videos are
+evicted once the directory grows over its size limit.
+"""
+
+import hashlib
+import os
+from typing import Optional
+
+VIDEO_CACHE_DIR = os.environ.get("VIDEOCACHE_DIR", "cache")
+"""The directory the videos are cached in."""
+
+VIDEO_CACHE_MAX_BYTES = int(os.environ.get("VIDEOCACHE_MAX_BYTES", 2 * 1024**3))
+"""The total size of cached videos above which the oldest ones are evicted."""
+
+
+def video_cache_key(python_code: str) -> str:
+    """Return the cache key of the video rendered from the given code."""
+    return hashlib.blake2b(python_code.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(VIDEO_CACHE_DIR, key + ".mp4")
+
+
+def lookup_video(key: str) -> Optional[str]:
+    """Return the path of the cached video for the key, if any.
+
+    A hit refreshes the modification time of the file, which is used for LRU eviction.
+    """
+    path = _cache_path(key)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def download_path(key: str, tag: str) -> str:
+    """Return a temporary path inside the cache directory to download a video to.
+
+    Downloading next to the cached videos keeps the final move within a single
+    filesystem, whichever one the cache directory is on.
+
+    Args:
+        key: The cache key of the video.
+        tag: Distinguishes concurrent downloads of the same key, e.g. the session id.
+    """
+    os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+    return os.path.join(VIDEO_CACHE_DIR, f"{key}.{tag}.part")
+
+
+def store_video(key: str, file_path: str) -> str:
+    """Move a downloaded video into the cache and evict old entries.
+
+    Args:
+        key: The cache key of the video.
+        file_path: The path of the downloaded video, from `download_path`.
+
+    Returns:
+        str: The path of the cached video.
+    """
+    os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+    path = _cache_path(key)
+    os.replace(file_path, path)
+    _evict(keep=path)
+    return path
+
+
+def _evict(keep: str) -> None:
+    """Remove the least recently used videos until the cache fits its size limit."""
+    entries = []
+    for entry in os.scandir(VIDEO_CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".mp4"):
+            # Another chat may evict the same file concurrently
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= VIDEO_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size